@@ -1,25 +1,33 @@
 from nmigen import *
-from math import ceil, log2
 from nmigen.sim import *
+from nmigen.lib.io import *
 from nmigen_soc.memory import *
 from nmigen_soc.wishbone import *
 from nmigen_boards.resources import *
 
-# (Dummy SPI resources for simulated tests)
-class DummyPin():
-  def __init__( self, name ):
-    self.o = Signal( name = '%s_o'%name )
-    self.i = Signal( name = '%s_i'%name )
-class DummySPI():
-  def __init__( self ):
-    self.cs   = DummyPin( 'cs' )
-    self.clk  = DummyPin( 'clk' )
-    self.mosi = DummyPin( 'mosi' )
-    self.miso = DummyPin( 'miso' )
+import array
+import sys
+
+# SPI pin layout, matching the 'spi_flash_1x' resource. Used for
+# simulated tests, so that the module sees the same pins in
+# simulation and in hardware. Dual-output reads also use MOSI
+# as an input, so it is bidirectional in that case.
+def spi_layout( dual ):
+  return [
+    ( "cs",   pin_layout( 1, "o" ) ),
+    ( "clk",  pin_layout( 1, "o" ) ),
+    ( "mosi", pin_layout( 1, "io" if dual else "o" ) ),
+    ( "miso", pin_layout( 1, "i" ) )
+  ]
+
+# Reverse the byte order of a 32-bit value. SPI Flash returns
+# bytes in address order, but words are stored little-endian.
+def byte_swap( v ):
+  return Cat( v[ 24 : 32 ], v[ 16 : 24 ], v[ 8 : 16 ], v[ :8 ] )
 
 # Core SPI Flash "ROM" module.
 class SPI_ROM( Elaboratable, Interface ):
-  def __init__( self, dat_start, dat_end, data ):
+  def __init__( self, dat_start, dat_end, data, fast = True, dual = False ):
     # Starting address in the Flash chip. This probably won't
     # be zero, because many FPGA boards use their external SPI
     # Flash to store the bitstream which configures the chip.
@@ -28,19 +36,61 @@ class SPI_ROM( Elaboratable, Interface ):
     self.dend = dat_end
     # Length of accessible data.
     self.dlen = ( dat_end - dat_start ) + 1
-    # SPI Flash address command.
-    self.spio = Signal( 32, reset = 0x03000000 )
-    # Data counter.
-    self.dc = Signal( 5, reset = 0b000000 )
+    # SPI Flash read command. 'Fast read' (0x0B) can run at the
+    # chip's maximum clock speed, but it needs 8 'dummy' cycles
+    # between the address and the data. The plain 'read' command
+    # (0x03) is often limited to half of that speed.
+    # 'Dual output fast read' (0x3B) also uses 8 dummy cycles, but
+    # then returns 2 bits per clock on the MOSI and MISO pins.
+    # That needs a bidirectional MOSI pin, so it is not the default.
+    # It only runs at the 'fast read' clock speed, so it cannot be
+    # combined with 'fast = False'.
+    if dual and not fast:
+      raise ValueError( "Dual output reads are always fast reads; 'dual' requires 'fast'" )
+    self.dual = dual
+    if dual:
+      self.cmd = 0x3B
+      self.dummy = 8
+    else:
+      self.cmd = 0x0B if fast else 0x03
+      self.dummy = 8 if fast else 0
+    # Number of clock cycles to receive each word of data.
+    self.rx_clocks = 16 if dual else 32
+    # Shift register for the outgoing SPI Flash address command,
+    # followed by any dummy cycles.
+    self.tx_sr = Signal( 32 + self.dummy, reset = self.cmd << ( 24 + self.dummy ) )
+    # Shift register for incoming SPI Flash data.
+    self.rx_sr = Signal( 32, reset = 0 )
+    # Data counter. It counts down from 31 while powering up, and
+    # from the number of bits / clocks left in each transfer.
+    self.dc = Signal( range( max( 32, len( self.tx_sr ) ) ), reset = 0 )
 
-    # Initialize Wishbone bus interface.
-    Interface.__init__( self, addr_width = ceil( log2( self.dlen + 1 ) ), data_width = 32 )
+    # Initialize Wishbone bus interface. The address bus only
+    # needs to be wide enough to address 'dlen' bytes.
+    Interface.__init__( self, addr_width = max( 1, ( self.dlen - 1 ).bit_length() ), data_width = 32 )
     self.memory_map = MemoryMap( addr_width = self.addr_width, data_width = self.data_width, alignment = 0 )
 
-    # Backing data store for a test ROM image. Not used when
-    # the module is built for real hardware.
+    # Line buffer: bus masters usually read words sequentially,
+    # so each read command fetches an aligned line of 8 words
+    # (the Flash chip auto-increments its address while CS is
+    # held) and later reads from the same line are served from
+    # this buffer without another SPI transaction.
+    self.line = Array( Signal( 32, name = 'line_%d'%i ) for i in range( 8 ) )
+    # Which line is currently buffered, and whether it is valid.
+    self.line_base = Signal( len( self.adr[ 5: ] ) )
+    self.line_valid = Signal( reset = 0 )
+    # Word counter for filling the line buffer.
+    self.wc = Signal( 3, reset = 0 )
+
+    # Test ROM image. The backing Memory is only created when the
+    # module is simulated, so hardware builds never include it.
+    # The image is packed into an array of unsigned 32-bit words,
+    # which rejects values that do not fit in a word. ('I' is a C
+    # 'unsigned int', so check that it really is 32 bits wide.)
     if data is not None:
-      self.data = Memory( width = 32, depth = len( data ), init = data )
+      self.data = array.array( 'I', data )
+      if self.data.itemsize != 4:
+        raise ValueError( "array typecode 'I' is not 32 bits wide" )
     else:
       self.data = None
 
@@ -48,14 +98,46 @@ class SPI_ROM( Elaboratable, Interface ):
     m = Module()
 
     if platform is None:
-      self.spi = DummySPI()
+      self.spi = Record( spi_layout( self.dual ), name = 'spi' )
+    elif self.dual:
+      # Dual-output reads use the MOSI and MISO pins as a 2-bit
+      # bidirectional bus; map it back onto separate pins.
+      flash = platform.request( 'spi_flash_2x' )
+      self.spi = Record( spi_layout( True ), name = 'spi' )
+      m.d.comb += [
+        flash.cs.o.eq( self.spi.cs.o ),
+        flash.clk.o.eq( self.spi.clk.o ),
+        flash.dq.o.eq( Cat( self.spi.mosi.o, 0 ) ),
+        flash.dq.oe.eq( self.spi.mosi.oe ),
+        self.spi.mosi.i.eq( flash.dq.i[ 0 ] ),
+        self.spi.miso.i.eq( flash.dq.i[ 1 ] )
+      ]
     else:
       self.spi = platform.request( 'spi_flash_1x' )
 
-    # Clock rests at 0.
-    m.d.comb += self.spi.clk.o.eq( 0 )
-    # SPI Flash can only address 24 bits.
-    m.d.comb += self.spio.eq( ( 0x03000000 | ( ( self.adr + self.dstart ) & 0x00FFFFFF ) ) )
+    # 'End of transfer' decoder, shared by the 'SPI_TX' and 'SPI_RX'
+    # states so that only one comparator is built for it.
+    dc_zero = Signal()
+    m.d.comb += dc_zero.eq( self.dc == 0 )
+    # 24-bit Flash address of the start of the requested line.
+    line_adr = Signal( 24 )
+    m.d.comb += line_adr.eq( Cat( Const( 0, 5 ), self.adr[ 5: ] ) + self.dstart )
+    # Simulated Flash data store for tests: a Memory read port,
+    # and a shift register which holds each simulated word while it
+    # is sent MSbit-first, 1 or 2 bits per clock cycle.
+    if platform is None:
+      rom = Memory( width = 32, depth = len( self.data ), init = self.data )
+      m.submodules.rdport = rdport = rom.read_port( domain = "sync" )
+      sim_sr = Signal( 32, reset = 0 )
+      sim_bits = 32 // self.rx_clocks
+    # Next value of the 'receive' shift register: the 'miso' bit
+    # is shifted in at the LSbit on every rising clock edge.
+    # For dual-output reads, 'miso' carries the higher bit of
+    # each pair and 'mosi' carries the lower one.
+    if self.dual:
+      rx_next = Cat( self.spi.mosi.i, self.spi.miso.i, self.rx_sr[ :-2 ] )
+    else:
+      rx_next = Cat( self.spi.miso.i, self.rx_sr[ :-1 ] )
 
     # Use a state machine for Flash access.
     # "Mode 0" SPI is very simple:
@@ -63,93 +145,161 @@ class SPI_ROM( Elaboratable, Interface ):
     # - Clock goes low, both sides write their bit if necessary.
     # - Clock goes high, both sides read their bit if necessary.
     # - Repeat ad nauseum.
-    with m.FSM() as fsm:
+    with m.FSM( reset = "SPI_RESET" ) as fsm:
       # 'Reset' and 'power-up' states:
       # pull CS low, then release power-down mode by sending 0xAB.
       # Normally this is not necessary, but iCE40 chips shut down
       # their connected SPI Flash after configuring themselves
       # in order to save power and prevent unintended writes.
       with m.State( "SPI_RESET" ):
-        m.d.sync += self.spi.cs.o.eq( 1 )
+        m.d.sync += [
+          self.spi.cs.o.eq( 1 ),
+          self.dc.eq( 31 )
+        ]
         m.next = "SPI_POWERUP"
       with m.State( "SPI_POWERUP" ):
-        m.d.sync += self.dc.eq( self.dc + 1 )
-        m.d.comb += self.spi.clk.o.eq( ~ClockSignal( "sync" ) )
-        m.d.comb += self.spi.mosi.o.eq( 0xAB >> ( 7 - self.dc ) )
+        # 'dc' only ever counts down, so it only needs a decrementer.
+        m.d.sync += self.dc.eq( self.dc - 1 )
+        # 0xAB is a constant, so look its bits up MSbit-first
+        # instead of shifting it by a variable amount.
+        m.d.comb += self.spi.mosi.o.eq(
+          Array( ( 0xAB >> ( 7 - i ) ) & 0b1 for i in range( 8 ) )[ ~self.dc[ :3 ] ] )
+        # De-assert CS after sending 8 bits of data; 'cs' only
+        # depends on 'dc', so there is no need for extra branches.
+        m.d.sync += self.spi.cs.o.eq( self.dc >= 24 )
         # Wait a few extra cycles after ending the transaction to
         # allow the chip to wake up from sleep mode.
         # TODO: Time this based on clock frequency?
-        with m.If( self.dc == 30 ):
-          m.d.sync += self.spi.cs.o.eq( 0 )
+        with m.If( self.dc == 1 ):
           m.next = "SPI_WAITING"
-        # De-assert CS after sending 8 bits of data = 16 clock edges.
-        with m.Elif( self.dc >= 8 ):
-          m.d.sync += self.spi.cs.o.eq( 0 )
-          m.next = "SPI_POWERUP"
-        # Toggle the 'clk' pin every cycle.
-        with m.Else():
-          m.next = "SPI_POWERUP"
       # 'Waiting' state: Keep the 'cs' pin high until a new read is
-      # requested, then move to 'SPI_TX' to send the read command.
-      # Also keep 'ack' asserted until 'stb' is released.
+      # requested. Serve it from the line buffer if possible,
+      # otherwise move to 'SPI_TX' to send the read command.
+      # 'ack' is only asserted for one cycle per request; a master
+      # which keeps 'stb' asserted after that starts a new read.
       with m.State( "SPI_WAITING" ):
         m.d.sync += [
-          self.ack.eq( self.cyc & ( self.ack & self.stb ) ),
+          self.ack.eq( self.stb & self.cyc & ~self.ack ),
           self.spi.cs.o.eq( 0 )
         ]
         m.next = "SPI_WAITING"
         with m.If( ( self.cyc == 1 ) & ( self.stb == 1 ) & ( self.ack == 0 ) ):
-          m.d.sync += [
-            self.spi.cs.o.eq( 1 ),
-            self.ack.eq( 0 ),
-            self.dc.eq( 31 )
-          ]
-          m.next = "SPI_TX"
-      # 'Send read command' state: transmits the 0x03 'read' command
-      # followed by the desired 24-bit address. (Encoded in 'spio')
+          # Line buffer hit: return the word on the next cycle.
+          with m.If( self.line_valid & ( self.adr[ 5: ] == self.line_base ) ):
+            m.d.sync += [
+              self.ack.eq( 1 ),
+              self.dat_r.eq( self.line[ self.adr[ 2 : 5 ] ] )
+            ]
+          # Line buffer miss: load the read command and the 24-bit
+          # address of the start of the line into the 'transmit'
+          # shift register. SPI Flash can only address 24 bits, so
+          # the upper byte holds the command. The dummy cycles
+          # (if any) are sent as zeros. (This is just wiring; no
+          # masking or OR-ing is needed to build the command.)
+          with m.Else():
+            m.d.sync += [
+              self.spi.cs.o.eq( 1 ),
+              self.ack.eq( 0 ),
+              self.dc.eq( len( self.tx_sr ) - 1 ),
+              self.wc.eq( 0 ),
+              self.line_base.eq( self.adr[ 5: ] ),
+              self.tx_sr.eq( Cat( Const( 0, self.dummy ), line_adr, Const( self.cmd, 8 ) ) )
+            ]
+            m.next = "SPI_TX"
+      # 'Send read command' state: transmits the read command
+      # followed by the desired 24-bit address and any dummy
+      # cycles. (Loaded in 'tx_sr')
       with m.State( "SPI_TX" ):
-        # Set the 'mosi' pin to the next value and increment 'dc'.
-        m.d.comb += self.spi.mosi.o.eq( self.spio >> self.dc )
-        m.d.sync += self.dc.eq( self.dc - 1 )
-        m.d.comb += self.spi.clk.o.eq( ~ClockSignal( "sync" ) )
-        # Move to 'receive data' state once 32 bits have elapsed.
-        # Also clear 'dat_r' and 'dc' before doing so.
-        with m.If( self.dc == 0 ):
-          m.d.sync += [
-            self.dc.eq( 7 ),
-            self.dat_r.eq( 0 )
-          ]
+        # Set the 'mosi' pin to the MSbit of the shift register,
+        # then shift it left by one and decrement 'dc'.
+        m.d.comb += self.spi.mosi.o.eq( self.tx_sr[ -1 ] )
+        m.d.sync += [
+          self.tx_sr.eq( self.tx_sr << 1 ),
+          self.dc.eq( self.dc - 1 )
+        ]
+        # Move to 'receive data' state once every bit has been sent.
+        # Fetch the first simulated word of the line for tests.
+        if platform is None:
+          m.d.comb += rdport.addr.eq( Cat( Const( 0, 3 ), self.line_base ) )
+        with m.If( dc_zero ):
+          m.d.sync += self.dc.eq( self.rx_clocks - 1 )
+          if platform is None:
+            m.d.sync += sim_sr.eq( byte_swap( rdport.data ) )
           m.next = "SPI_RX"
         with m.Else():
           m.next = "SPI_TX"
-      # 'Receive data' state: continue the clock signal and read
-      # the 'miso' pin on rising edges.
-      # You can keep the clock signal going to receive as many bytes
-      # as you want, but this implementation only fetches one word.
-      # Bytes are received in 'little-endian' format, MSbit-first.
+      # 'Receive data' state: continue the clock signal and shift
+      # the 'miso' pin into 'rx_sr' on rising edges.
+      # The clock signal keeps going until all 8 words in the
+      # line have been received, but the requested word is
+      # acknowledged as soon as it arrives. A new request made
+      # while the line is still filling waits in 'SPI_WAITING'.
+      # Bytes are received in address order, MSbit-first.
       with m.State( "SPI_RX" ):
-        # Simulate the 'miso' pin value for tests.
+        # Simulate the 'miso' pin value for tests, and fetch the
+        # next simulated word of the line.
         if platform is None:
-          m.d.comb += self.spi.miso.i.eq( ( self.data[ self.adr >> 2 ] >> self.dc ) & 0b1 )
+          if self.dual:
+            m.d.comb += Cat( self.spi.mosi.i, self.spi.miso.i ).eq( sim_sr[ -2: ] )
+          else:
+            m.d.comb += self.spi.miso.i.eq( sim_sr[ -1 ] )
+          m.d.comb += rdport.addr.eq( Cat( self.wc, self.line_base ) + 1 )
+          m.d.sync += sim_sr.eq( sim_sr << sim_bits )
         m.d.sync += [
+          self.ack.eq( 0 ),
           self.dc.eq( self.dc - 1 ),
-          self.dat_r.eq( self.dat_r | ( self.spi.miso.i << self.dc ) )
+          self.rx_sr.eq( rx_next )
         ]
-        m.d.comb += self.spi.clk.o.eq( ~ClockSignal( "sync" ) )
-        # Assert 'ack' signal and move back to 'waiting' state
-        # once a whole word of data has been received.
-        with m.If( self.dc[ :3 ] == 0 ):
-          with m.If( self.dc[ 3 : 5 ] == 0b11 ):
+        # Serve reads from the line which is being filled: words
+        # which have already been stored come from the line buffer,
+        # and the word which is arriving is acknowledged as soon as
+        # its last bit has been received. Other reads wait until the
+        # fill is complete.
+        with m.If( self.stb & self.cyc & ~self.ack & ( self.adr[ 5: ] == self.line_base ) ):
+          with m.If( self.adr[ 2 : 5 ] < self.wc ):
+            m.d.sync += [
+              self.ack.eq( 1 ),
+              self.dat_r.eq( self.line[ self.adr[ 2 : 5 ] ] )
+            ]
+          with m.Elif( dc_zero & ( self.adr[ 2 : 5 ] == self.wc ) ):
+            m.d.sync += [
+              self.ack.eq( 1 ),
+              self.dat_r.eq( byte_swap( rx_next ) )
+            ]
+        # Store each little-endian word in the line buffer once it
+        # has been received.
+        with m.If( dc_zero ):
+          m.d.sync += [
+            self.dc.eq( self.rx_clocks - 1 ),
+            self.wc.eq( self.wc + 1 ),
+            self.line[ self.wc ].eq( byte_swap( rx_next ) )
+          ]
+          if platform is None:
+            m.d.sync += sim_sr.eq( byte_swap( rdport.data ) )
+          # Release CS and move back to 'waiting' state once the
+          # whole line has been received.
+          with m.If( self.wc == 7 ):
             m.d.sync += [
               self.spi.cs.o.eq( 0 ),
-              self.ack.eq( self.cyc )
+              self.line_valid.eq( 1 )
             ]
             m.next = "SPI_WAITING"
-          with m.Else():
-            m.d.sync += self.dc.eq( self.dc + 15 )
-            m.next = "SPI_RX"
-        with m.Else():
-          m.next = "SPI_RX"
+
+    # Pin the state machine to a one-hot encoding rather than
+    # leaving it up to the toolchain's FSM recoding pass.
+    fsm.state.attrs[ "fsm_encoding" ] = "one-hot"
+    fsm.state.attrs[ "syn_encoding" ] = "onehot"
+
+    # Toggle the 'clk' pin every cycle while a command is being sent
+    # or data is being received. Otherwise, the clock rests at 0.
+    m.d.comb += self.spi.clk.o.eq( ~ClockSignal( "sync" ) & (
+      fsm.ongoing( "SPI_POWERUP" ) | fsm.ongoing( "SPI_TX" ) | fsm.ongoing( "SPI_RX" ) ) )
+    # For dual-output reads, the MOSI and MISO pins share one output
+    # enable. Only drive them while a command is being sent, so they
+    # are never driven while the Flash chip may still be driving
+    # them after a read.
+    if self.dual:
+      m.d.comb += self.spi.mosi.oe.eq( fsm.ongoing( "SPI_POWERUP" ) | fsm.ongoing( "SPI_TX" ) )
 
     # (End of SPI Flash "ROM" module logic)
     return m
@@ -157,24 +307,43 @@ class SPI_ROM( Elaboratable, Interface ):
 ##############################
 # SPI Flash "ROM" testbench: #
 ##############################
+# Test ROM image: two 8-word lines.
+test_rom = [ 0x89ABCDEF, 0x0C0FFEE0, 0xBABABABA, 0xABACADAB,
+             0xDEADFACE, 0x12345678, 0x87654321, 0xDEADBEEF,
+             0xDEADBEEF, 0x01234567, 0xFEEBEEDE, 0x0BADF00D,
+             0xC0DEC0DE, 0x55AA55AA, 0xFFFFFFFF, 0x00000000 ]
+
+# Expected 'rx_sr' progress after each tick of a word, as
+# ( mask, shift ) pairs for 1 or 2 bits per clock. These only
+# need to be computed once.
+rx_steps = { bits: [ ( ( 1 << n ) - 1, 32 - n ) for n in range( bits, 33, bits ) ]
+             for bits in ( 1, 2 ) }
+
 # Keep track of test pass / fail rates.
 p = 0
 f = 0
+# Test results are buffered and written out once per run, rather
+# than printing a line for every check.
+ut_log = []
 
 # Helper method to record unit test pass/fails.
 def spi_rom_ut( name, actual, expected ):
   global p, f
   if expected != actual:
     f += 1
-    print( "\033[31mFAIL:\033[0m %s (0x%08X != 0x%08X)"
-           %( name, actual, expected ) )
+    ut_log.append( "\033[31mFAIL:\033[0m %s (0x%08X != 0x%08X)"
+                   %( name, actual, expected ) )
   else:
     p += 1
-    print( "\033[32mPASS:\033[0m %s (0x%08X == 0x%08X)"
-           %( name, actual, expected ) )
+    ut_log.append( "\033[32mPASS:\033[0m %s (0x%08X == 0x%08X)"
+                   %( name, actual, expected ) )
 
-# Helper method to test reading a byte of SPI data.
-def spi_read_word( srom, virt_addr, phys_addr, simword, end_wait ):
+# Helper method to test reading a word of SPI data which is not
+# in the line buffer. 'phys_addr' is the Flash address of the
+# start of the line, and 'simline' holds the line's 8 words.
+# 'follow' lists more addresses in the same line, which are read
+# one after another while the line is still being filled.
+def spi_read_word( srom, virt_addr, phys_addr, simline, end_wait, follow = () ):
   # Set 'address'.
   yield srom.adr.eq( virt_addr )
   # Set 'strobe' and 'cycle' to request a new read.
@@ -185,36 +354,109 @@ def spi_read_word( srom, virt_addr, phys_addr, simword, end_wait ):
   yield Tick()
   yield Settle()
   csa = yield srom.spi.cs.o
-  spcmd = yield srom.spio
+  spcmd = yield srom.tx_sr
   spi_rom_ut( "CS Low", csa, 1 )
-  spi_rom_ut( "SPI Read Cmd Value", spcmd, ( phys_addr & 0x00FFFFFF ) | 0x03000000 )
-  # Then the 32-bit read command is sent; two ticks per bit.
-  for i in range( 32 ):
+  spi_rom_ut( "SPI Read Cmd Value", spcmd,
+              ( ( phys_addr & 0x00FFFFFF ) | ( srom.cmd << 24 ) ) << srom.dummy )
+  # Then the 32-bit read command is sent, followed by any dummy
+  # cycles; two ticks per bit. Collect the 'mosi' bits and check
+  # them all at once.
+  bits = []
+  for i in range( 32 + srom.dummy ):
     yield Settle()
     dout = yield srom.spi.mosi.o
-    spi_rom_ut( "SPI Read Cmd  [%d]"%i, dout, ( spcmd >> ( 31 - i ) ) & 0b1 )
+    bits.append( dout )
     yield Tick()
-  # The following 32 bits should return the word. Simulate
-  # the requested word arriving on the MISO pin, MSbit first.
+  spi_rom_ut( "SPI Read Cmd  Bits", int( "".join( str( b ) for b in bits ), 2 ), spcmd )
+  # The following 8 * 32 bits should return the line. Simulate
+  # the words arriving on the MISO pin, MSbit first.
   # (Data starts getting returned on the falling clock edge
   #  immediately following the last rising-edge read.)
-  i = 7
-  expect = 0
-  while i < 32:
-    yield Tick()
-    yield Settle()
-    expect = expect | ( ( 1 << i ) & simword )
-    progress = yield srom.dat_r
-    spi_rom_ut( "SPI Read Word [%d]"%i, progress, expect )
-    if ( ( i & 0b111 ) == 0 ):
-      i = i + 15
-    else:
-      i = i - 1
+  # Bytes arrive in address order, so each word is byte-swapped
+  # while it is being shifted in. Dual-output reads receive
+  # 2 bits per tick.
+  # 'ack' should be asserted for one cycle as soon as each
+  # requested word is available, while the rest of the line keeps
+  # filling. Reset 'strobe' and 'cycle' N ticks after that to
+  # test delayed reads from the bus, and request the next 'follow'
+  # address on the following tick.
+  reads = [ virt_addr ] + list( follow )
+  r = 0
+  req_tick = 0
+  ticks = 1 + 32 + srom.dummy
+  acks = []
+  hold = None
+  steps = rx_steps[ 32 // srom.rx_clocks ]
+  for w in range( 8 ):
+    simbytes = int.from_bytes( simline[ w ].to_bytes( 4, 'little' ), 'big' )
+    for i, ( mask, shift ) in enumerate( steps ):
+      yield Tick()
+      yield Settle()
+      ticks += 1
+      # (Bits left over from the previous word are ignored.)
+      progress = yield srom.rx_sr
+      spi_rom_ut( "SPI Read Word %d [%d]"%( w, i ), progress & mask, simbytes >> shift )
+      if hold is not None:
+        hold -= 1
+      elif len( acks ) > r and r + 1 < len( reads ):
+        r += 1
+        req_tick = ticks
+        yield srom.adr.eq( reads[ r ] )
+        yield srom.stb.eq( 1 )
+        yield srom.cyc.eq( 1 )
+      ack = yield srom.ack
+      if ack:
+        acks.append( ticks )
+        # The requested word should be latched into 'dat_r' on the
+        # tick after it was requested, or as soon as it arrives.
+        word = ( reads[ r ] >> 2 ) & 0b111
+        latency = max( req_tick + 1, 1 + 32 + srom.dummy + ( word + 1 ) * srom.rx_clocks )
+        dout = yield srom.dat_r
+        spi_rom_ut( "SPI Read Word", dout, simline[ word ] )
+        spi_rom_ut( "Read Latency", ticks, latency )
+        hold = end_wait
+      if hold == 0:
+        yield srom.stb.eq( 0 )
+        yield srom.cyc.eq( 0 )
+        hold = None
+  spi_rom_ut( "Ack Count", len( acks ), len( reads ) )
   # Wait one more tick, then the CS signal should be de-asserted.
   yield Tick()
   yield Settle()
   csa = yield srom.spi.cs.o
   spi_rom_ut( "CS High (Waiting)", csa, 0 )
+  # Dual-output reads should not drive MOSI / MISO while waiting.
+  if srom.dual:
+    oe = yield srom.spi.mosi.oe
+    spi_rom_ut( "MOSI Released (Waiting)", oe, 0 )
+  # 'ack' should only be asserted for one cycle.
+  ack = yield srom.ack
+  spi_rom_ut( "Ack Released", ack, 0 )
+  # Done; reset 'strobe' and 'cycle' if that has not happened yet.
+  if hold is not None:
+    for i in range( max( 0, hold - 1 ) ):
+      yield Tick()
+  yield srom.stb.eq( 0 )
+  yield srom.cyc.eq( 0 )
+  yield Tick()
+  yield Settle()
+
+# Helper method to test reading a word from the line buffer.
+def spi_read_hit( srom, virt_addr, simword, end_wait ):
+  # Set 'address', 'strobe' and 'cycle' to request a new read.
+  yield srom.adr.eq( virt_addr )
+  yield srom.stb.eq( 1 )
+  yield srom.cyc.eq( 1 )
+  # The word should be returned after one tick, without
+  # asserting the CS pin.
+  yield Tick()
+  yield Settle()
+  csa = yield srom.spi.cs.o
+  spi_rom_ut( "CS High (Line Hit)", csa, 0 )
+  ack = yield srom.ack
+  spi_rom_ut( "Ack", ack, 1 )
+  dout = yield srom.dat_r
+  spi_rom_ut( "Line Hit Word", dout, simword )
   # Done; reset 'strobe' and 'cycle' after N ticks to test
   # delayed reads from the bus.
   for i in range( end_wait ):
@@ -227,6 +469,8 @@ def spi_read_word( srom, virt_addr, phys_addr, simword, end_wait ):
 # Top-level SPI ROM test method.
 def spi_rom_tests( srom ):
   global p, f
+  p = 0
+  f = 0
 
   # Let signals settle after reset.
   yield Tick()
@@ -235,36 +479,51 @@ def spi_rom_tests( srom ):
   # Print a test header.
   print( "--- SPI Flash 'ROM' Tests ---" )
 
-  # Test basic behavior by reading a few consecutive words.
-  yield from spi_read_word( srom, 0x00, 0x200000, 0x89ABCDEF, 0 )
-  yield from spi_read_word( srom, 0x04, 0x200004, 0x0C0FFEE0, 4 )
+  # Test basic behavior by reading a few words. The first read
+  # fills the line buffer; sequential reads which arrive while it
+  # is filling are served as their words arrive, and later reads
+  # from the line are served from the buffer.
+  yield from spi_read_word( srom, 0x00, 0x200000, test_rom[ 0 : 8 ], 0, ( 0x04, 0x08 ) )
+  yield from spi_read_hit( srom, 0x04, test_rom[ 1 ], 4 )
   for i in range( 4 ):
     yield Tick()
     yield Settle()
     csa = yield srom.spi.cs.o
     spi_rom_ut( "CS High (Waiting)", csa, 0 )
-  yield from spi_read_word( srom, 0x10, 0x200010, 0xDEADFACE, 1 )
-  yield from spi_read_word( srom, 0x0C, 0x20000C, 0xABACADAB, 1 )
+  yield from spi_read_hit( srom, 0x10, test_rom[ 4 ], 1 )
+  yield from spi_read_hit( srom, 0x0C, test_rom[ 3 ], 1 )
+  # Reading from a different line should refill the buffer. Words
+  # which have already been stored are served straight away.
+  yield from spi_read_word( srom, 0x28, 0x200020, test_rom[ 8 : 16 ], 1, ( 0x20, 0x2C ) )
+  yield from spi_read_hit( srom, 0x3C, test_rom[ 15 ], 0 )
+  yield from spi_read_word( srom, 0x1C, 0x200000, test_rom[ 0 : 8 ], 1 )
 
-  # Done. Print the number of passed and failed unit tests.
+  # Done. Write out the test results, and print the number of
+  # passed and failed unit tests.
   yield Tick()
+  sys.stdout.write( "\n".join( ut_log ) + "\n" )
+  ut_log.clear()
   print( "SPI 'ROM' Tests: %d Passed, %d Failed"%( p, f ) )
 
 # 'main' method to run a basic testbench.
 if __name__ == "__main__":
-  # Instantiate a test SPI ROM module.
-  off = ( 2 * 1024 * 1024 )
-  dut = SPI_ROM( off, off + 1024, [ 0x89ABCDEF, 0x0C0FFEE0, 0xBABABABA, 0xABACADAB, 0xDEADFACE, 0x12345678, 0x87654321, 0xDEADBEEF, 0xDEADBEEF ] )
+  # Test the 'fast read', plain 'read' and 'dual output read' commands.
+  for name, cfg in ( ( "fast", { 'fast': True } ),
+                     ( "slow", { 'fast': False } ),
+                     ( "dual", { 'dual': True } ) ):
+    # Instantiate a test SPI ROM module.
+    off = ( 2 * 1024 * 1024 )
+    dut = SPI_ROM( off, off + 1024, test_rom, **cfg )
 
-  # Run the SPI ROM tests.
-  sim = Simulator( dut )
-  def proc():
-    # Wait until the 'release power-down' command is sent.
-    # TODO: test that startup condition.
-    for i in range( 30 ):
-      yield Tick()
-    yield from spi_rom_tests( dut )
-  sim.add_clock( 1e-6 )
-  sim.add_sync_process( proc )
-  with sim.write_vcd( "spi_rom.vcd" ):
-    sim.run()
+    # Run the SPI ROM tests.
+    sim = Simulator( dut )
+    def proc():
+      # Wait until the 'release power-down' command is sent.
+      # TODO: test that startup condition.
+      for i in range( 30 ):
+        yield Tick()
+      yield from spi_rom_tests( dut )
+    sim.add_clock( 1e-6 )
+    sim.add_sync_process( proc )
+    with sim.write_vcd( "spi_rom_%s.vcd"%name ):
+      sim.run()